@@ -171,6 +171,16 @@ const Home = () => {
               );
               break;
 
+            case 'error':
+              setMessages((prev) =>
+                prev.map((msg) =>
+                  msg.id === aiResponseId
+                    ? { ...msg, content: streamedContent || "Sorry, the server is busy. Please try again.", isLoading: false }
+                    : msg
+                )
+              );
+              break;
+
             case 'end':
               if (searchData) {
                 const finalSearchInfo = {
@@ -1,27 +1,40 @@
 from typing import TypedDict, Annotated, Optional
 from langgraph.graph import add_messages, StateGraph, END
 # from langchain_google_genai import ChatGoogleGenerativeAI
-from langchain_core.messages import HumanMessage, AIMessageChunk, ToolMessage
+from langchain_core.messages import HumanMessage, ToolMessage
+from langchain_core.tools import ToolException
 from dotenv import load_dotenv
 from langchain_tavily import TavilySearch
 import os
+import logging
+import asyncio
+import httpx
 from openai import OpenAI
 from langchain_openai import ChatOpenAI
 
 
 from langchain_community.tools.tavily_search import TavilySearchResults
-from fastapi import FastAPI, Query
-from fastapi.responses import StreamingResponse
+from fastapi import FastAPI
+from starlette.requests import Request
+from starlette.responses import StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
-import json
+import orjson
 from uuid import uuid4
+from hashlib import blake2b
+from cachetools import TTLCache
 from langgraph.checkpoint.memory import MemorySaver
+from langgraph.checkpoint.redis.aio import AsyncRedisSaver
+from contextlib import AsyncExitStack, suppress
 
 load_dotenv()
 # print("GOOGLE_API_KEY:", os.getenv("GOOGLE_API_KEY"))
 # print("OPEN_API_KEY:", os.getenv("OPENAI_API_KEY"))
 # Initialize memory saver for checkpointing
+# in-process fallback for local dev; swapped for redis on startup when REDIS_URL is set
 memory = MemorySaver()
+REDIS_URL = os.getenv("REDIS_URL")
+# keeps the redis connection open for the lifetime of the app
+_checkpointer_stack = AsyncExitStack()
 
 class State(TypedDict):
     messages: Annotated[list, add_messages]
@@ -31,8 +44,48 @@ search_tool = TavilySearch(
     max_results=4,
 )
 
+# TavilySearch opens a fresh http session per call and takes no client argument,
+# so searches go through one pooled client that keeps TLS connections alive
+TAVILY_SEARCH_URL = "https://api.tavily.com/search"
+tavily_http = httpx.AsyncClient(
+    timeout=10,
+    limits=httpx.Limits(max_keepalive_connections=50, max_connections=100),
+    headers={"Authorization": f"Bearer {os.getenv('TAVILY_API_KEY', '')}"},
+)
+
+async def run_search(tool_args):
+    # validate the model's args against the tool schema and drop unset ones, like the langchain wrapper does
+    search_args = search_tool.args_schema(**tool_args).model_dump(exclude_none=True)
+    response = await tavily_http.post(
+        TAVILY_SEARCH_URL,
+        json={**search_args, "max_results": search_tool.max_results},
+    )
+    response.raise_for_status()
+    search_results = response.json()
+
+    if not search_results.get("results"):
+        # same guidance TavilySearch gives the model, so it retries with a looser search
+        suggestions = [
+            f"Remove {arg} argument"
+            for arg in ("time_range", "include_domains", "exclude_domains")
+            if search_args.get(arg)
+        ]
+        if search_args.get("search_depth", "basic") == "basic":
+            suggestions.append("Try a more detailed search using 'advanced' search_depth")
+        if search_args.get("topic", "general") != "general":
+            suggestions.append("Try a general search using 'general' topic")
+        raise ToolException(
+            f"No search results found for '{search_args['query']}'. "
+            f"Suggestions: {', '.join(suggestions)}. "
+            "Try modifying your search parameters with one of these approaches."
+        )
+    return search_results
+
 tools = [search_tool]
 
+# the name the model uses in its tool calls
+SEARCH_TOOL_NAME = search_tool.name
+
 # llm = ChatGoogleGenerativeAI(model='gemini-2.0-flash-001') # initialize the class
 # llm = ChatOpenAI(model="gpt-4o")
 llm = ChatOpenAI(model = "gpt-4.1-mini")
@@ -40,8 +93,40 @@ print(f"Using model: {llm.model_name}")  # Add this line to verify
 
 llm_with_tools = llm.bind_tools(tools=tools)
 
+# shared across all sessions: caps in-flight model calls so bursts of users queue
+# here instead of tripping provider rate limits and paying for retry backoff
+model_slots = asyncio.Semaphore(int(os.getenv("MAX_MODEL_CALLS", "64")))
+# how long a turn may wait for a free slot before the client gets an error frame
+MODEL_SLOT_TIMEOUT = float(os.getenv("MODEL_SLOT_TIMEOUT", "30"))
+
+class ModelBusyError(Exception):
+    """Raised when no model slot frees up within MODEL_SLOT_TIMEOUT."""
+
+def compact_messages(messages):
+    """Drop tool calls and search results from earlier turns to cut prompt tokens."""
+    # find the current user turn; everything after it (tool calls + results) stays as is
+    current = len(messages) - 1
+    while current >= 0 and not isinstance(messages[current], HumanMessage):
+        current -= 1
+    if current <= 0: # first turn, nothing to compact
+        return messages
+
+    # earlier turns keep their question and final answer, which already sums up what the search found
+    history = [
+        msg for msg in messages[:current]
+        if not isinstance(msg, ToolMessage) and not getattr(msg, "tool_calls", None)
+    ]
+    return [*history, *messages[current:]]
+
 async def model(state: State):
-    result = await llm_with_tools.ainvoke(state["messages"])
+    try:
+        await asyncio.wait_for(model_slots.acquire(), MODEL_SLOT_TIMEOUT)
+    except asyncio.TimeoutError:
+        raise ModelBusyError(f"no model slot free after {MODEL_SLOT_TIMEOUT:g}s") from None
+    try:
+        result = await llm_with_tools.ainvoke(compact_messages(state["messages"]))
+    finally:
+        model_slots.release()
     return {
         "messages": [result], 
     }
@@ -54,34 +139,78 @@ async def tools_router(state: State):
     else: 
         return END
     
+# characters that would break a grid cell; cells containing them get quoted
+_GRID_SPECIAL = frozenset(',;[]"\n')
+
+def _grid_cell(value):
+    text = value if isinstance(value, str) else str(value)
+    if _GRID_SPECIAL.isdisjoint(text):
+        return text
+    return orjson.dumps(text).decode()
+
+# longest snippet of each search result fed back to the model
+SNIPPET_CHARS = 400
+
+def compact_search_results(search_results):
+    """Grid-encode tavily results as url,title,snippet rows so the next model call prefills less."""
+    if isinstance(search_results, Exception):
+        # keep the type: some errors (httpx timeouts) have an empty message
+        return f"{type(search_results).__name__}: {search_results}"
+
+    # tavily returns {"results": [...], ...}; anything else (raw lists etc) goes through as text
+    results = search_results.get("results") if isinstance(search_results, dict) else search_results
+    if not isinstance(results, list):
+        return str(search_results)
+
+    rows = [
+        ",".join((
+            _grid_cell(item.get("url", "")),
+            _grid_cell(item.get("title", "")),
+            _grid_cell((item.get("content") or "")[:SNIPPET_CHARS]),
+        ))
+        for item in results
+        if isinstance(item, dict)
+    ]
+    return f"[{len(rows)}: u,t,s; " + "; ".join(rows) + "]"
+
+def search_result_urls(search_results):
+    # Extract URLs from the search results too show on UI
+    if not isinstance(search_results, dict):
+        return []
+    return [
+        item["url"] for item in search_results.get("results", [])
+        if isinstance(item, dict) and "url" in item
+    ]
+
 async def tool_node(state):
     """Custom tool node that handles tool calls from the LLM."""
     # Get the tool calls from the last message
     tool_calls = state["messages"][-1].tool_calls
     
-    # Initialize list to store tool messages
-    tool_messages = []
-    
-    # Process each tool call
-    for tool_call in tool_calls:
-        tool_name = tool_call["name"]
-        tool_args = tool_call["args"]
-        tool_id = tool_call["id"]
-        
-        # Handle the search tool
-        if tool_name == "tavily_search_results":
-        # if tool_name == "tavily_search_results_json":
-            # Execute the search tool with the provided arguments
-            search_results = await search_tool.ainvoke(tool_args)
-            
-            # Create a ToolMessage for this result
-            tool_message = ToolMessage(
-                content=str(search_results),
-                tool_call_id=tool_id,
-                name=tool_name
-            )
-            
-            tool_messages.append(tool_message)
+    # Only the search tool is handled here
+    search_calls = [
+        tool_call for tool_call in tool_calls
+        if tool_call["name"] == SEARCH_TOOL_NAME
+    ]
+
+    # Run every search concurrently instead of one round-trip after another
+    # exceptions come back as results so one failed search doesn't drop the others
+    search_results = await asyncio.gather(
+        *(run_search(tool_call["args"]) for tool_call in search_calls),
+        return_exceptions=True
+    )
+
+    # Create a ToolMessage for each result, matched back to its tool call
+    tool_messages = [
+        ToolMessage(
+            content=compact_search_results(result),
+            tool_call_id=tool_call["id"],
+            name=tool_call["name"],
+            artifact=search_result_urls(result), # for the client, never sent to the model
+            status="error" if isinstance(result, Exception) else "success"
+        )
+        for tool_call, result in zip(search_calls, search_results)
+    ]
     
     # Add the tool messages to the state
     return {"messages": tool_messages}
@@ -99,84 +228,90 @@ graph = graph_builder.compile(checkpointer=memory)
 
 app = FastAPI() # initialized the fast api app
 
+@app.on_event("startup")
+async def setup_checkpointer():
+    # redis-backed checkpoints survive reloads and are shared across workers
+    global memory, graph
+    if REDIS_URL:
+        memory = await _checkpointer_stack.enter_async_context(
+            AsyncRedisSaver.from_conn_string(REDIS_URL)
+        )
+        await memory.asetup() # creates the redis search indices if missing
+        graph = graph_builder.compile(checkpointer=memory)
+
+@app.on_event("shutdown")
+async def close_checkpointer():
+    await _checkpointer_stack.aclose()
+
+@app.on_event("shutdown")
+async def close_search_client():
+    await tavily_http.aclose()
+
 # Add CORS middleware with settings that match frontend requirements
 # browser/client to comunicate w server endpoint
+# explicit allowlist is a plain string compare per request; comma separated in ALLOWED_ORIGINS
+# EventSource doesnt send credentials so the credentials handling is switched off
+ALLOWED_ORIGINS = [
+    origin.strip() for origin in os.getenv("ALLOWED_ORIGINS", "").split(",")
+    if origin.strip()
+]
+if not ALLOWED_ORIGINS:
+    # keep the old allow-all behaviour so an unconfigured deploy still serves the frontend
+    ALLOWED_ORIGINS = ["*"]
+    logging.getLogger("uvicorn.error").warning(
+        "ALLOWED_ORIGINS is not set, allowing every origin; set it to the frontend origin(s), "
+        "e.g. ALLOWED_ORIGINS=http://localhost:3000"
+    )
+
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=["*"],  # too permissive for production
-    allow_credentials=True,
-    allow_methods=["*"],  
+    allow_origins=ALLOWED_ORIGINS,
+    allow_credentials=False,
+    allow_methods=["GET"],  
     allow_headers=["*"], 
     expose_headers=["Content-Type"], 
 )
 
-def serialise_ai_message_chunk(chunk): 
-    # method will check whether this chunk is an instance of AI Message chunk
-    if(isinstance(chunk, AIMessageChunk)):
-        return chunk.content
-    else: # if error
-        raise TypeError(
-            f"Object of type {type(chunk).__name__} is not correctly formatted for serialisation"
-        )
+# built once, sent on every stream: stop proxies (nginx etc.) from caching or buffering the sse frames
+_STREAM_HEADERS = {
+    "cache-control": "no-cache",
+    "x-accel-buffering": "no",
+}
 
-async def generate_chat_responses(message: str, checkpoint_id: Optional[str] = None):
-    is_new_conversation = checkpoint_id is None # checking checkpoint id
-    
-    if is_new_conversation:
-        # Generate new checkpoint ID for first message in conversation
-        new_checkpoint_id = str(uuid4())
+# static frames built once at import instead of formatted on every request
+_END_FRAME = b'data: {"type":"end"}\n\n'
+_CHECKPOINT_FRAME = 'data: {{"type":"checkpoint","checkpoint_id":"{}"}}\n\n'.format
 
-        config = { # constructing the config object
-            "configurable": {
-                "thread_id": new_checkpoint_id
-            }
-        }
-        
-        # Initialize with first message
-        events = graph.astream_events(
-            {"messages": [HumanMessage(content=message)]},
-            version="v2",
-            config=config
-        )
-        
-        # First send the checkpoint ID
-        # yeild or emit the events
-        # \ to escape ""
-        yield f"data: {{\"type\": \"checkpoint\", \"checkpoint_id\": \"{new_checkpoint_id}\"}}\n\n" # thats how browser will know that its a sse
-    else: # existing conversation
-        config = {
-            "configurable": {
-                "thread_id": checkpoint_id
-            }
-        }
-        # Continue existing conversation
-        events = graph.astream_events(
-            {"messages": [HumanMessage(content=message)]},
-            version="v2",
-            config=config
-        )
+def _sse(payload):
+    # orjson returns bytes, so the frame goes out without a str -> bytes encode
+    return b"data: " + orjson.dumps(payload) + b"\n\n"
+
+# new-conversation answers keyed by the opening message
+# each entry is (joined sse frames, [question, final answer]) so search payloads arent kept per entry
+response_cache = TTLCache(maxsize=1_000, ttl=300)
 
-    async for event in events:
-        event_type = event["event"]
+async def stream_event_frames(events):
+    # turns graph stream parts into sse frames for the client
+    # "messages" carries model tokens, "updates" carries each node's finished output
+    async for mode, payload in events:
         # so client can differentiate between each event type        
-        if event_type == "on_chat_model_stream":
-            # grabbing message chunk and passing inside method
-            
-            chunk_content = serialise_ai_message_chunk(event["data"]["chunk"])
+        if mode == "messages":
+            chunk, metadata = payload
+            # only model tokens go to the client; content=empty on tool call
+            if metadata["langgraph_node"] != "model" or not chunk.content:
+                continue
 
             # Escape single quotes and newlines manually for safe JSON parsing
             # safe_content = chunk_content.replace("'", "\\'").replace("\n", "\\n")
             
-            safe_content = json.dumps(chunk_content)
             #yielding this data/json to client
             # yield f"data: {{\"type\": \"content\", \"content\": \"{safe_content}\"}}\n\n" # sse protocol
-            yield f"data: {json.dumps({'type': 'content', 'content': chunk_content})}\n\n"
+            yield _sse({"type": "content", "content": chunk.content})
 
-            # content=empty on tool call
-        elif event_type == "on_chat_model_end":
-            # Check if there are tool calls for search
-            tool_calls = event["data"]["output"].tool_calls if hasattr(event["data"]["output"], "tool_calls") else []
-            search_calls = [call for call in tool_calls if call["name"] == "tavily_search_results_json"]
+        elif "model" in payload:
+            # model finished - check if there are tool calls for search
+            tool_calls = getattr(payload["model"]["messages"][-1], "tool_calls", None) or []
+            search_calls = [call for call in tool_calls if call["name"] == SEARCH_TOOL_NAME]
             
             if search_calls:
                 # Signal that a search is starting
@@ -184,42 +319,115 @@ async def generate_chat_responses(message: str, checkpoint_id: Optional[str] = N
                 # Escape quotes and special characters
                 # safe_query = search_query.replace('"', '\\"').replace("'", "\\'").replace("\n", "\\n")
 
-                safe_query = json.dumps(search_query)
                 # yield f"data: {{\"type\": \"search_start\", \"query\": \"{safe_query}\"}}\n\n"
-                yield f"data: {json.dumps({'type': 'search_start', 'query': search_query})}\n\n"
-
+                yield _sse({"type": "search_start", "query": search_query})
 
-            # tool end will have all the info of tool                
-        elif event_type == "on_tool_end" and event["name"] == "tavily_search_results_json":
-            # Search completed - send results or error
-            output = event["data"]["output"]
-            
-            # Check if output is a list 
-            if isinstance(output, list): # o/p(response of tavily search) will be a list
-                # Extract URLs from list of search results too show on UI
-                urls = []
-                for item in output:
-                    if isinstance(item, dict) and "url" in item:
-                        urls.append(item["url"])
-                
-                # Convert URLs to JSON and yield them
-                urls_json = json.dumps(urls)
+        elif "tool_node" in payload:
+            # Search completed - tool node keeps the result urls on each message to show on UI
+            for tool_message in payload["tool_node"]["messages"]:
                 # yield f"data: {{\"type\": \"search_results\", \"urls\": {urls_json}}}\n\n"
-                yield f"data: {json.dumps({'type': 'search_results', 'urls': urls})}\n\n"
+                yield _sse({"type": "search_results", "urls": tool_message.artifact or []})
+
+
+# marks the end of the frame queue
+_STREAM_DONE = object()
+
+async def drive_graph(events, frame_queue):
+    # producer side: pushes encoded frames until the graph finishes
+    try:
+        async for frame in stream_event_frames(events):
+            await frame_queue.put(frame)
+    except Exception:
+        await frame_queue.put(_STREAM_DONE) # wake the consumer, it gets the error from the task
+        raise
+    await frame_queue.put(_STREAM_DONE)
+
+async def generate_chat_responses(message: str, checkpoint_id: Optional[str] = None):
+    is_new_conversation = checkpoint_id is None # checking checkpoint id
+    # Generate new checkpoint ID for first message in conversation, otherwise continue the existing one
+    thread_id = uuid4().hex if is_new_conversation else checkpoint_id
+
+    config = { # constructing the config object
+        "configurable": {
+            "thread_id": thread_id
+        }
+    }
+
+    if is_new_conversation:
+        # same opening question -> replay the stored answer instead of re-running search + model
+        cache_key = blake2b(message.encode(), digest_size=16).hexdigest()
+        cached = response_cache.get(cache_key)
+        if cached is not None:
+            stream, messages = cached
+            # seed the new thread so follow-up questions still have the conversation history
+            await graph.aupdate_state(config, {"messages": messages}, as_node="model")
+            yield _CHECKPOINT_FRAME(thread_id).encode()
+            yield stream
+            yield _END_FRAME
+            return
+
+    events = graph.astream(
+        {"messages": [HumanMessage(content=message)]},
+        config=config,
+        stream_mode=["messages", "updates"]
+    )
+
+    if is_new_conversation:
+        # First send the checkpoint ID
+        # yeild or emit the events
+        yield _CHECKPOINT_FRAME(thread_id).encode() # thats how browser will know that its a sse
+
+    # graph runs in its own task so a slow reader doesnt stall the model stream
+    frame_queue = asyncio.Queue(maxsize=64)
+    producer = asyncio.create_task(drive_graph(events, frame_queue))
+
+    # only a new conversation can be cached, so only those buffer their frames
+    frames = [] if is_new_conversation else None
+    try:
+        while (frame := await frame_queue.get()) is not _STREAM_DONE:
+            if frames is not None:
+                frames.append(frame)
+            yield frame
+        await producer # re-raises if the graph failed
+    except ModelBusyError as exc:
+        # too many turns in flight: tell the client instead of leaving the stream silent
+        yield _sse({"type": "error", "error": str(exc)})
+        yield _END_FRAME
+        return
+    finally:
+        # a finished graph was already awaited above; only a still-running one needs tearing down
+        if not producer.done():
+            # client went away: stop the graph so no more tokens are billed
+            producer.cancel()
+            with suppress(asyncio.CancelledError):
+                await producer
+
+    if is_new_conversation:
+        # only completed streams get here, an abandoned request never fills the cache
+        state = await graph.aget_state(config)
+        messages = state.values["messages"]
+        # a failed search (timeout, bad key, no results) must not be replayed to everyone asking the same thing
+        if not any(getattr(msg, "status", None) == "error" for msg in messages):
+            response_cache[cache_key] = (b"".join(frames), [messages[0], messages[-1]])
 
-    
     # Send an end event
-    yield f"data: {{\"type\": \"end\"}}\n\n"
+    yield _END_FRAME
 
-@app.get("/chat_stream/{message}") # user entered message info will come here
+# user entered message info will come here
 # 2nd argument. = checkpoint id = provided as a query parameter
 # default to none if client doesnt provide. a checkpoint id
-async def chat_stream(message: str, checkpoint_id: Optional[str] = Query(None)):
-    return StreamingResponse( # class of fastapi
+# plain starlette handler: no pydantic validation or dependency injection on the streaming hot path
+async def chat_stream(request: Request):
+    message = request.path_params["message"]
+    checkpoint_id = request.query_params.get("checkpoint_id")
+    return StreamingResponse( # class of starlette
         generate_chat_responses(message, checkpoint_id), # providing generator function 1st=will emit events anytime it receives something
-        media_type="text/event-stream"
+        media_type="text/event-stream",
+        headers=_STREAM_HEADERS
     )
 
+app.add_route("/chat_stream/{message}", chat_stream, methods=["GET"])
+
 @app.get("/")
 def read_root():
     return {"message": "🚀 Perplexity chatbot backend is live"}